@@ -3,18 +3,12 @@
 Authors  :: Pierre Schumacher (schumacherpier@gmail.com), Vikash Kumar (vikashplus@gmail.com), Vittorio Caggiano (caggiano@gmail.com)
 ================================================= """
 
-import collections
 import math
-from myosuite.utils import gym
 import numpy as np
 import os
 from enum import Enum
-from typing import Optional, Tuple
 
-from myosuite.envs.myo.base_v0 import BaseV0
-from myosuite.envs.myo.myobase.walk_v0 import WalkEnvV0
-from myosuite.utils.quat_math import quat2euler, euler2mat, euler2quat
-from abc import abstractmethod
+from myosuite.utils.quat_math import quat2euler, euler2mat
 
 
 class TerrainTypes(Enum):
@@ -102,7 +96,11 @@ class HeightField:
         self.sim = sim
         self._init_height_points()
         self.hfield = sim.model.hfield('terrain')
-        self.heightmap_window = None
+        # map conversion factors are fixed for the lifetime of the hfield
+        self._inv_delta_map_x = self.nrow / self.real_length
+        self._inv_delta_map_y = self.ncol / self.real_width
+        self._map_offset_x = self.hfield.data.shape[0] / 2
+        self._map_offset_y = self.hfield.data.shape[1] / 2
         self.rng = rng
         self.view_distance = view_distance
 
@@ -110,10 +108,8 @@ class HeightField:
         """
         Get heightmap observation.
         """
-        if self.heightmap_window is None:
-            self.heightmap_window = np.zeros((10, 10))
-        self._measure_height()
-        return self.heightmap_window[:].flatten().copy()
+        # flatten copies the oriented window view in a single pass
+        return self._measure_height().flatten()
 
     def cart2map(self,
                  points_1: list,
@@ -123,13 +119,9 @@ class HeightField:
         If only points_1 is given: Expects cartesian positions in [x, y] format.
         If also points_2 is given: Expects points_1 = [x1, x2, ...] points_2 = [y1, y2, ...]
         """
-        delta_map_x = self.real_length / self.nrow
-        delta_map_y = self.real_width / self.ncol
-        offset_x = self.hfield.data.shape[0] / 2
-        offset_y = self.hfield.data.shape[1] / 2
         # x, y needs to be switched to match hfield.
-        ret1 = np.array(points_1[:] / delta_map_x + offset_x, dtype=np.int16)
-        ret2 = np.array(points_2[:] / delta_map_y + offset_y, dtype=np.int16)
+        ret1 = np.array(points_1[:] * self._inv_delta_map_x + self._map_offset_x, dtype=np.int16)
+        ret2 = np.array(points_2[:] * self._inv_delta_map_y + self._map_offset_y, dtype=np.int16)
         # avoid out-of-bounds by clipping indices to map boundaries
         # -2 because we go one further and shape is 1 longer than map index
         ret1 = np.clip(ret1, 0, self.hfield.data.shape[0] - 2)
@@ -155,7 +147,8 @@ class HeightField:
     def _measure_height(self):
             """
             Update heights at grid points around
-            model.
+            model. Returns a (10, 10) view of the measured heights
+            in the egocentric frame of the model.
             """
             rot_direction = quat2euler(self.sim.data.qpos[3:7])[2]
             rot_mat = euler2mat([0, 0, rot_direction])
@@ -176,7 +169,7 @@ class HeightField:
                 self.length = 0
             self.length += 1
             # align with egocentric view of model
-            self.heightmap_window[:] = np.flipud(np.rot90(heights.reshape(10, 10), axes=(1,0)))
+            return np.flipud(np.rot90(heights.reshape(10, 10), axes=(1,0)))
 
     @property
     def size(self):
@@ -212,6 +205,7 @@ class ChaseTagField(HeightField):
         self.relief_range = relief_range
         self.patches_per_side = patches_per_side
         self.patch_size = int(self.nrow / patches_per_side)
+        self._init_hilly_templates()
         self._populate_patches()
 
     def flatten_agent_patch(self, qpos):
@@ -238,15 +232,20 @@ class ChaseTagField(HeightField):
             raise NotImplementedError
 
     def _populate_patches(self):
-            generated_terrains = np.zeros((len(TerrainTypes)))
-            for i in range(self.patches_per_side):
-                for j in range(self.patches_per_side):
-                    terrain_type = self.rng.choice(TerrainTypes)
-                    # maximum of 2 hilly
-                    while terrain_type.name == 'HILLY' and generated_terrains[TerrainTypes.HILLY.value] >= 2:
-                        terrain_type = self.rng.choice(TerrainTypes)
-                    generated_terrains[terrain_type.value] += 1
-                    self._fill_patch(i, j, terrain_type)
+            # draw the terrain types of all patches at once
+            terrain_types = self.rng.choice(len(TerrainTypes), size=self.patches_per_side * self.patches_per_side)
+            # maximum of 2 hilly, surplus hilly patches are redrawn from the other types
+            hilly_idx = np.flatnonzero(terrain_types == TerrainTypes.HILLY.value)[2:]
+            if hilly_idx.size > 0:
+                terrain_types[hilly_idx] = self.rng.choice([TerrainTypes.FLAT.value, TerrainTypes.ROUGH.value], size=hilly_idx.size)
+            terrain_types = terrain_types.reshape(self.patches_per_side, self.patches_per_side)
+            # all flat patches are cleared with a single masked write
+            flat_mask = np.repeat(np.repeat(terrain_types == TerrainTypes.FLAT.value, self.patch_size, axis=0), self.patch_size, axis=1)
+            covered = self.patches_per_side * self.patch_size
+            self.hfield.data[:covered, :covered][flat_mask] = 0.0
+            # only the remaining patches need their own data
+            for i, j in zip(*np.nonzero(terrain_types != TerrainTypes.FLAT.value)):
+                self._fill_patch(i, j, TerrainTypes(terrain_types[i, j]))
             # put special terrain only once in 20% of episodes
             if self.rng.uniform() < 0.2:
                 i, j = self.rng.integers(0, self.patches_per_side, size=2)
@@ -291,18 +290,25 @@ class ChaseTagField(HeightField):
         normalized_data = (relief - np.min(relief)) / (np.max(relief) - np.min(relief))
         return np.flipud(normalized_data) * self.rng.uniform(self.relief_range[0], self.relief_range[1])
 
+    def _init_hilly_templates(self):
+        """
+        The hilly waveform only depends on the patch size, precompute it
+        once normalized to [0, 1], flipped and in both orientations.
+        """
+        frequency = 10
+        data = np.sin(np.linspace(0, frequency * np.pi, self.patch_size * self.patch_size) + np.pi / 2)
+        # sin(x) - 1 lies in [-2, 0], so normalizing to [0, 1] reduces to (sin(x) + 1) / 2
+        template = ((data + 1) / 2).reshape(self.patch_size, self.patch_size)[::-1, ::-1]
+        self._hilly_template = np.ascontiguousarray(template)
+        self._hilly_template_rot = np.ascontiguousarray(np.rot90(template))
+
     def _compute_hilly_terrain(self):
         """
         Compute data for a terrain with smooth hills.
         """
-        frequency = 10
         scalar = self.rng.uniform(low=self.hills_range[0], high=self.hills_range[1])
-        data = np.sin(np.linspace(0, frequency * np.pi, self.patch_size * self.patch_size) + np.pi / 2) - 1
-        normalized_data = (data - data.min()) / (data.max() - data.min())
-        normalized_data = np.flip(normalized_data.reshape(self.patch_size, self.patch_size) * scalar, [0, 1]).reshape(self.patch_size, self.patch_size)
-        if self.rng.uniform() < 0.5:
-            normalized_data = np.rot90(normalized_data)
-        return normalized_data
+        template = self._hilly_template_rot if self.rng.uniform() < 0.5 else self._hilly_template
+        return template * scalar
     
 
 class TrackField(HeightField):
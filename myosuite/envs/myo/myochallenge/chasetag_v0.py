@@ -4,6 +4,7 @@ Authors  :: Vikash Kumar (vikashplus@gmail.com), Vittorio Caggiano (caggiano@gma
 ================================================= """
 
 import collections
+import math
 from myosuite.utils import gym
 import numpy as np
 import pink
@@ -22,6 +23,24 @@ class Task(Enum):
     EVADE = 1
 
 
+def _step_opponent_pose(x, y, qw, qx, qy, qz, lin_vel, rot_vel, dt):
+    """
+    Advance the planar opponent pose by one timestep.
+    Works on plain scalars, as the mocap body only ever rotates around the z-axis.
+    :return: x, y and the (w, z) components of the new yaw-only quaternion.
+    """
+    lin_vel = min(max(lin_vel, -2.0), 2.0)
+    rot_vel = min(max(rot_vel, -2.0), 2.0)
+    # yaw of the mocap quaternion
+    angle = math.atan2(2 * (qw * qz + qx * qy), 1 - 2 * (qy * qy + qz * qz))
+    x -= dt * lin_vel * math.cos(angle + 0.5 * math.pi)
+    y -= dt * lin_vel * math.sin(angle + 0.5 * math.pi)
+    x = min(max(x, -5.5), 5.5)
+    y = min(max(y, -5.5), 5.5)
+    half_angle = 0.5 * (angle + dt * rot_vel)
+    return x, y, math.cos(half_angle), math.sin(half_angle)
+
+
 class ChallengeOpponent:
     """
     Training Opponent for the Locomotion Track of the MyoChallenge 2023.
@@ -57,6 +76,27 @@ class ChallengeOpponent:
 
     def reset_noise_process(self):
         self.noise_process = pink.ColoredNoiseProcess(beta=2, size=(2, 2000), scale=10, rng=self.rng)
+        self._fill_noise_buffer()
+
+    def _fill_noise_buffer(self):
+        """
+        Cache the scaled time series of the noise process, with one row per timestep.
+        """
+        self._noise_buf = self.noise_process.scale * self.noise_process.buffer.T
+        self._noise_idx = 0
+
+    def sample_noise(self):
+        """
+        Draw the next sample of the colored noise process. Equivalent to
+        `noise_process.sample()`, but reads from the cached buffer.
+        """
+        if self._noise_idx >= self._noise_buf.shape[0]:
+            # start a new time series, same as the noise process does once its buffer is used up
+            self.noise_process.reset()
+            self._fill_noise_buffer()
+        sample = self._noise_buf[self._noise_idx]
+        self._noise_idx += 1
+        return sample
 
     def get_opponent_pose(self):
         """
@@ -64,8 +104,11 @@ class ChallengeOpponent:
         :return: The  pose.
         :rtype: list -> [x, y, angle]
         """
-        angle = quat2euler(self.sim.data.mocap_quat[0, :])[-1]
-        return np.concatenate([self.sim.data.mocap_pos[0, :2], [angle]])
+        mocap_pos = self.sim.data.mocap_pos[0]
+        q = self.sim.data.mocap_quat[0]
+        # yaw of the mocap quaternion, roll and pitch are always zero
+        angle = math.atan2(2 * (q[0] * q[3] + q[1] * q[2]), 1 - 2 * (q[2] * q[2] + q[3] * q[3]))
+        return np.array([mocap_pos[0], mocap_pos[1], angle])
 
     def set_opponent_pose(self, pose: list):
         """
@@ -74,7 +117,12 @@ class ChallengeOpponent:
         :type pose: list -> [x, y, angle]
         """
         self.sim.data.mocap_pos[0, :2] = pose[:2]
-        self.sim.data.mocap_quat[0, :] = euler2quat([0, 0, pose[-1]])
+        # the opponent only rotates around the z-axis
+        half_angle = 0.5 * pose[-1]
+        mocap_quat = self.sim.data.mocap_quat[0]
+        mocap_quat[0] = math.cos(half_angle)
+        mocap_quat[1:3] = 0.0
+        mocap_quat[3] = math.sin(half_angle)
 
     def move_opponent(self, vel: list):
         """
@@ -88,22 +136,18 @@ class ChallengeOpponent:
         self.opponent_vel = vel
         assert len(vel) == 2
         vel[0] = np.abs(vel[0])
-        vel = np.clip(vel, -2, 2)
-        pose = self.get_opponent_pose()
-        x_vel = vel[0] * np.cos(pose[-1]+0.5*np.pi)
-        y_vel = vel[0] * np.sin(pose[-1] +0.5*np.pi)
-        pose[0] -= self.dt * x_vel
-        pose[1] -= self.dt * y_vel
-        pose[2] += self.dt * vel[1]
-        pose[:2] = np.clip(pose[:2], -5.5, 5.5)
-        self.set_opponent_pose(pose)
+        mocap_pos = self.sim.data.mocap_pos[0]
+        mocap_quat = self.sim.data.mocap_quat[0]
+        mocap_pos[0], mocap_pos[1], mocap_quat[0], mocap_quat[3] = _step_opponent_pose(
+            mocap_pos[0], mocap_pos[1], *mocap_quat, vel[0], vel[1], self.dt)
+        mocap_quat[1:3] = 0.0
 
     def random_movement(self):
         """
         This moves the opponent randomly in a correlated
         pattern.
         """
-        return np.clip(self.noise_process.sample(), self.random_vel_range[0], self.random_vel_range[1])
+        return np.clip(self.sample_noise(), self.random_vel_range[0], self.random_vel_range[1])
 
     def sample_opponent_policy(self):
         """
@@ -123,7 +167,8 @@ class ChallengeOpponent:
         one of the control policies.
         """
         if self.opponent_policy == 'stationary' or self.opponent_policy == 'static_stationary':
-            opponent_vel = np.zeros(2,)
+            # the pose is already set on reset and the velocity stays zero, nothing to move
+            return
 
         elif self.opponent_policy == 'random':
             opponent_vel = self.random_movement()
@@ -153,10 +198,16 @@ class ChallengeOpponent:
         else:
             raise NotImplementedError
 
-        dist = 0
-        while dist < self.min_spawn_distance:
-            pose = [self.rng.uniform(-5, 5), self.rng.uniform(-5, 5), self.rng.uniform(- 2 * np.pi, 2 * np.pi)]
-            dist = np.linalg.norm(pose[:2] - self.sim.data.body('root').xpos[:2])
+        # draw spawn candidates in batches and keep the first one far enough from the model
+        root_pos = self.sim.data.body('root').xpos[:2]
+        min_spawn_distance_sq = self.min_spawn_distance ** 2
+        valid_idx = []
+        while len(valid_idx) == 0:
+            candidates = self.rng.uniform(-5, 5, size=(16, 2))
+            diff = candidates - root_pos
+            dist_sq = np.einsum('ij,ij->i', diff, diff)
+            valid_idx = np.flatnonzero(dist_sq >= min_spawn_distance_sq)
+        pose = np.append(candidates[valid_idx[0]], self.rng.uniform(- 2 * np.pi, 2 * np.pi))
         if self.opponent_policy == "static_stationary":
             pose[:] = [0, -5, 0]
         self.set_opponent_pose(pose)
@@ -214,7 +265,7 @@ class RepellerChallengeOpponent(ChallengeOpponent):
         self.opponent_probabilities = probabilities
 
         self.min_spawn_distance = min_spawn_distance
-        self.noise_process = pink.ColoredNoiseProcess(beta=2, size=(2, 2000), scale=10, rng=rng)
+        self.reset_noise_process()
         self.chase_vel_range = chase_vel_range
         self.random_vel_range = random_vel_range
         self.repeller_vel_range = repeller_vel_range
@@ -270,7 +321,7 @@ class RepellerChallengeOpponent(ChallengeOpponent):
 
         # Take a random step if no repellers are close by, making it a non-stationary target
         if len(dist_idx) == 0:
-            lin, rot = self.noise_process.sample()
+            lin, rot = self.sample_noise()
             escape_linear = np.clip(lin, self.repeller_vel_range[0], self.repeller_vel_range[1])
             escape_ang_rot = self._calc_angular_vel(opponent_pos[2], rot)
             return np.hstack((escape_linear, escape_ang_rot))
@@ -347,7 +398,8 @@ class RepellerChallengeOpponent(ChallengeOpponent):
         one of the control policies.
         """
         if self.opponent_policy == 'stationary' or self.opponent_policy == 'static_stationary':
-            opponent_vel = np.zeros(2,)
+            # the pose is already set on reset and the velocity stays zero, nothing to move
+            return
 
         elif self.opponent_policy == 'random':
             opponent_vel = self.random_movement()
@@ -453,10 +505,20 @@ class ChaseTagEnvV0(WalkEnvV0):
                                               random_vel_range=random_vel_range)
 
         self.win_distance = win_distance
+        self.win_distance_sq = win_distance ** 2
+        # persistent view into the mujoco data, updated in-place on every step
+        self._pelvis_xpos = self.sim.data.body('pelvis').xpos
         self.grf_sensor_names = ['r_foot', 'r_toes', 'l_foot', 'l_toes']
+        # sensor buffers are updated in-place by mujoco, so the views stay valid across steps
+        self._grf_data_views = [self.sim.data.sensor(sens_name).data for sens_name in self.grf_sensor_names]
+        self._setup_obs_storage()
         self.success_indicator_sid = self.sim.model.site_name2id("opponent_indicator")
+        self.terrain_gid = self.sim.model.geom_name2id('terrain')
         self.current_task = Task.CHASE
         self.repeller_opponent = repeller_opponent
+        # fixed ordering of the weighted reward terms, so the dense reward is a single dot product
+        self._rwd_keys_order = tuple(weighted_reward_keys.keys())
+        self._rwd_weights = np.fromiter((weighted_reward_keys[key] for key in self._rwd_keys_order), dtype=np.float64, count=len(self._rwd_keys_order))
         super()._setup(obs_keys=obs_keys,
                        weighted_reward_keys=weighted_reward_keys,
                        reset_type=reset_type,
@@ -485,30 +547,63 @@ class ChaseTagEnvV0(WalkEnvV0):
         for x in self.opponent.opponent_probabilities:
             assert 0 <= x <= 1, "Probabilities should be between 0 and 1"
 
+    def _setup_obs_storage(self):
+        """
+        Compute the layout of the float observations inside a single contiguous buffer,
+        so that get_obs_dict only needs one allocation per step.
+        """
+        obs_sizes = [
+            ('time', 1),
+            ('internal_qpos', 28),
+            ('internal_qvel', 28),
+            ('grf', len(self.grf_sensor_names)),
+            ('torso_angle', 4),
+            ('muscle_length', self.sim.model.nu),
+            ('muscle_velocity', self.sim.model.nu),
+            ('muscle_force', self.sim.model.nu),
+        ]
+        if self.sim.model.na > 0:
+            obs_sizes.append(('act', self.sim.model.na))
+        obs_sizes += [
+            ('opponent_pose', 3),
+            ('opponent_vel', 2),
+            ('model_root_pos', 2),
+            ('model_root_vel', 2),
+        ]
+        self._obs_slices = {}
+        start = 0
+        for key, size in obs_sizes:
+            self._obs_slices[key] = slice(start, start + size)
+            start += size
+        self._obs_storage_size = start
+
     def get_obs_dict(self, sim):
-        obs_dict = {}
+        # all float entries are views into one buffer that is freshly allocated every step,
+        # so obs_dicts of earlier steps stay valid
+        obs_storage = np.empty(self._obs_storage_size)
+        obs_dict = {key: obs_storage[obs_slice] for key, obs_slice in self._obs_slices.items()}
 
         # Time
-        obs_dict['time'] = np.array([sim.data.time])
+        obs_dict['time'][0] = sim.data.time
 
         # proprioception
-        obs_dict['internal_qpos'] = sim.data.qpos[7:35].copy()
-        obs_dict['internal_qvel'] = sim.data.qvel[6:34].copy() * self.dt
-        obs_dict['grf'] = self._get_grf().copy()
-        obs_dict['torso_angle'] = self.sim.data.body('pelvis').xquat.copy()
+        np.copyto(obs_dict['internal_qpos'], sim.data.qpos[7:35])
+        np.multiply(sim.data.qvel[6:34], self.dt, out=obs_dict['internal_qvel'])
+        self._get_grf(out=obs_dict['grf'])
+        np.copyto(obs_dict['torso_angle'], self.sim.data.body('pelvis').xquat)
 
-        obs_dict['muscle_length'] = self.muscle_lengths()
-        obs_dict['muscle_velocity'] = self.muscle_velocities()
-        obs_dict['muscle_force'] = self.muscle_forces()
+        np.copyto(obs_dict['muscle_length'], self.muscle_lengths())
+        np.copyto(obs_dict['muscle_velocity'], self.muscle_velocities())
+        np.copyto(obs_dict['muscle_force'], self.muscle_forces())
 
         if sim.model.na>0:
-            obs_dict['act'] = sim.data.act[:].copy()
+            np.copyto(obs_dict['act'], sim.data.act)
 
         # exteroception
-        obs_dict['opponent_pose'] = self.opponent.get_opponent_pose()[:].copy()
-        obs_dict['opponent_vel'] = self.opponent.opponent_vel[:].copy()
-        obs_dict['model_root_pos'] = sim.data.qpos[:2].copy()
-        obs_dict['model_root_vel'] = sim.data.qvel[:2].copy()
+        np.copyto(obs_dict['opponent_pose'], self.opponent.get_opponent_pose())
+        np.copyto(obs_dict['opponent_vel'], self.opponent.opponent_vel)
+        np.copyto(obs_dict['model_root_pos'], sim.data.qpos[:2])
+        np.copyto(obs_dict['model_root_vel'], sim.data.qvel[:2])
 
         # active task
         obs_dict['task'] = np.array(self.current_task.value, ndmin=2, dtype=np.int16)
@@ -538,7 +633,9 @@ class ChaseTagEnvV0(WalkEnvV0):
         # ----------------------
 
         # Example reward, you should change this!
-        distance = np.linalg.norm(obs_dict['model_root_pos'][...,:2] - obs_dict['opponent_pose'][...,:2])
+        model_root_pos = obs_dict['model_root_pos'].ravel()
+        opponent_pose = obs_dict['opponent_pose'].ravel()
+        distance = math.hypot(model_root_pos[0] - opponent_pose[0], model_root_pos[1] - opponent_pose[1])
 
         rwd_dict = collections.OrderedDict((
             # Perform reward tuning here --
@@ -556,7 +653,8 @@ class ChaseTagEnvV0(WalkEnvV0):
                 ('solved',  win_cdt),
                 ('done',  self._get_done()),
             ))
-        rwd_dict['dense'] = np.sum([wt*rwd_dict[key] for key, wt in self.rwd_keys_wt.items()], axis=0)
+        rwd_vals = np.fromiter((rwd_dict[key] for key in self._rwd_keys_order), dtype=np.float64, count=len(self._rwd_keys_order))
+        rwd_dict['dense'] = float(self._rwd_weights @ rwd_vals)
 
         # Success Indicator
         self.sim.model.site_rgba[self.success_indicator_sid, :] = np.array([0, 2, 0, 0.2]) if rwd_dict['solved'] else np.array([2, 0, 0, 0])
@@ -619,12 +717,12 @@ class ChaseTagEnvV0(WalkEnvV0):
         """
         if not self.heightfield is None:
             self.heightfield.sample(self.np_random)
-            self.sim.model.geom_rgba[self.sim.model.geom_name2id('terrain')][-1] = 1.0
-            self.sim.model.geom_pos[self.sim.model.geom_name2id('terrain')] = np.array([0, 0, 0])
+            self.sim.model.geom_rgba[self.terrain_gid][-1] = 1.0
+            self.sim.model.geom_pos[self.terrain_gid] = np.array([0, 0, 0])
         else:
             # move heightfield down if not used
-            self.sim.model.geom_rgba[self.sim.model.geom_name2id('terrain')][-1] = 0.0
-            self.sim.model.geom_pos[self.sim.model.geom_name2id('terrain')] = np.array([0, 0, -10])
+            self.sim.model.geom_rgba[self.terrain_gid][-1] = 0.0
+            self.sim.model.geom_pos[self.terrain_gid] = np.array([0, 0, -10])
 
     def _randomize_position_orientation(self, qpos, qvel):
         qpos[:2]  = self.np_random.uniform(-5, 5, size=(2,))
@@ -687,12 +785,10 @@ class ChaseTagEnvV0(WalkEnvV0):
             qvel = self.sim.model.key_qvel[3].copy()
 
         # randomize qpos coordinates
-        # but dont change height or rot state
-        rot_state = qpos[3:7]
-        height = qpos[2]
-        qpos[:] = qpos[:] + self.np_random.normal(0, 0.02, size=qpos.shape)
-        qpos[3:7] = rot_state
-        qpos[2] = height
+        # but dont change height (qpos[2]) or rot state (qpos[3:7])
+        noise = self.np_random.normal(0, 0.02, size=qpos.shape[0] - 5)
+        qpos[:2] += noise[:2]
+        qpos[7:] += noise[2:]
         return qpos, qvel
 
     def _setup_convenience_vars(self):
@@ -734,7 +830,7 @@ class ChaseTagEnvV0(WalkEnvV0):
             raise NotImplementedError
 
     def _chase_lose_condition(self):
-        root_pos = self.sim.data.body('pelvis').xpos[:2]
+        root_pos = self._pelvis_xpos
         # didnt manage to tag
         if self.obs_dict['time'] >= self.maxTime:
             return 1
@@ -744,11 +840,10 @@ class ChaseTagEnvV0(WalkEnvV0):
         return 0
 
     def _evade_lose_condition(self):
-        root_pos = self.sim.data.body('pelvis').xpos[:2]
-        opp_pos = self.obs_dict['opponent_pose'][..., :2]
+        root_pos = self._pelvis_xpos
 
         # got caught
-        if np.linalg.norm(root_pos - opp_pos) <= self.win_distance and self.startFlag:
+        if self._get_opponent_distance_sq() <= self.win_distance_sq and self.startFlag:
             return 1
         # out-of-bounds
         if np.abs(root_pos[0]) > 6.5 or np.abs(root_pos[1]) > 6.5:
@@ -756,12 +851,20 @@ class ChaseTagEnvV0(WalkEnvV0):
         return 0
 
     def _chase_win_condition(self):
-        root_pos = self.sim.data.body('pelvis').xpos[:2]
-        opp_pos = self.obs_dict['opponent_pose'][..., :2]
-        if np.linalg.norm(root_pos - opp_pos) <= self.win_distance and self.startFlag:
+        if self._get_opponent_distance_sq() <= self.win_distance_sq and self.startFlag:
             return 1
         return 0
 
+    def _get_opponent_distance_sq(self):
+        """
+        Squared planar distance between the pelvis and the opponent.
+        """
+        # obs_dict entries carry leading dims during the reward computation
+        opp_pos = self.obs_dict['opponent_pose'].ravel()
+        dx = self._pelvis_xpos[0] - opp_pos[0]
+        dy = self._pelvis_xpos[1] - opp_pos[1]
+        return dx * dx + dy * dy
+
     def _evade_win_condition(self):
         # evade long enough
         if self.obs_dict['time'] >= self.maxTime:
@@ -798,23 +901,35 @@ class ChaseTagEnvV0(WalkEnvV0):
     def _get_muscle_fmax(self):
         return self.sim.model.actuator_gainprm[:, 2].copy()
 
-    def _get_grf(self):
-        return np.array([self.sim.data.sensor(sens_name).data[0] for sens_name in self.grf_sensor_names]).copy()
+    def _get_grf(self, out=None):
+        """
+        Read the ground reaction forces, optionally directly into <out>.
+        """
+        if out is None:
+            out = np.empty(len(self._grf_data_views))
+        for i, sens_data in enumerate(self._grf_data_views):
+            out[i] = sens_data[0]
+        return out
 
     def _get_pelvis_angle(self):
         return self.sim.data.body('pelvis').xquat.copy()
 
     def _get_joint_names(self):
         '''
-        Return a list of joint names according to the index ID of the joint angles
+        Return a tuple of joint names according to the index ID of the joint angles
         '''
-        return [self.sim.model.joint(jnt_id).name for jnt_id in range(1, self.sim.model.njnt)]
+        if not hasattr(self, '_joint_names'):
+            # joint 0 is the root freejoint, which is not part of the internal joint angles
+            self._joint_names = tuple(self.sim.model.joint(jnt_id).name for jnt_id in range(1, self.sim.model.njnt))
+        return self._joint_names
 
     def _get_actuator_names(self):
         '''
-        Return a list of actuator names according to the index ID of the actuators
+        Return a tuple of actuator names according to the index ID of the actuators
         '''
-        return [self.sim.model.actuator(act_id).name for act_id in range(1, self.sim.model.na)]
+        if not hasattr(self, '_actuator_names'):
+            self._actuator_names = tuple(self.sim.model.actuator(act_id).name for act_id in range(self.sim.model.nu))
+        return self._actuator_names
 
 
     def _get_fallen_condition(self):